@@ -7,13 +7,8 @@ This example assumes there is an Ubuntu Server VM up and running.
 See the README for specific details regarding the setup.
 """
 
-import sys
-import os
-
-# Add the root directory to the Python path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
-from src.device import LinuxDevice
-from src.connection import TelnetConnection
+from router_test_kit.device import LinuxDevice
+from router_test_kit.connection import TelnetConnection
 
 
 def main():
@@ -7,15 +7,11 @@ This example assumes there are two Ubuntu Server VMs up and running.
 See the README for specific details regarding the setup.
 """
 
-import sys
-import os
 import time
 
-# Add the root directory to the Python path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
-from src.device import LinuxDevice
-from src.connection import TelnetConnection
-from src.static_utils import get_packet_loss
+from router_test_kit.device import LinuxDevice
+from router_test_kit.connection import TelnetConnection
+from router_test_kit.static_utils import get_packet_loss
 
 
 def main():
@@ -34,4 +34,9 @@ setup(
     ],
     python_requires=">=3.7",
     install_requires=install_requires,
+    # Optional speedups, picked up at import time when installed
+    extras_require={
+        "netlink": ["pyroute2"],  # Read host interface addresses over netlink instead of parsing "ip addr"
+        "orjson": ["orjson"],  # Faster JSON config parsing
+    },
 )
@@ -23,15 +23,11 @@ import logging
 import re
 import socket
 import time
-import sys
-import os
 from abc import ABC, abstractmethod
 from typing import Optional, List, Union
 
 import telnetlib
 
-# Add the root directory to the Python path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
 from router_test_kit.device import Device
 
 
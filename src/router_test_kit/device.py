@@ -9,14 +9,23 @@ Actions do not originate from the device.
 """
 
 
+import atexit
 import logging
+import os
+import re
+import select
+import shlex
 import subprocess
+import time
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 
 logger = logging.getLogger(__name__)
 
+# Characters that need /bin/sh to be interpreted (pipes, redirections, expansions, quoting, etc.)
+SHELL_METACHARACTERS_RE = re.compile(r"[|&;<>`$(){}=\[\]*?~!#\"'\\\n]")
+
 
 class Device(ABC):
     """
@@ -26,14 +35,19 @@ class Device(ABC):
         username (str): The username for the device. Default is None.
         password (str): The password for the device. Default is None.
         hostname (str): The hostname of the device. Default is None.
-        _type (str): The type of the device. Default is "device".
+        _type (str): The type of the device, constant per class. Default is "device".
+
+    Instance attributes are stored in __slots__, so subclasses must declare their own
+    (possibly empty) __slots__ to keep instances free of a __dict__.
     """
 
+    __slots__ = ("username", "password", "hostname")
+    _type = "device"
+
     def __init__(self, username: Optional[str]=None, password: Optional[str]=None):
         self.username = username
         self.password = password
         self.hostname = None
-        self._type = "device"
 
     @property
     def type(self) -> str:
@@ -56,6 +70,8 @@ class Device(ABC):
 
 
 class LinuxDevice(Device):
+    __slots__ = ()
+    _type = "linux"
     DEFAULT_USERNAME = 'user'
     DEFAULT_PASSWORD = 'user'
     DEFAULT_PROMPT_SYMBOL = '$'  # Changes to '#' if root
@@ -64,17 +80,20 @@ class LinuxDevice(Device):
         username = username if username else self.DEFAULT_USERNAME
         password = password if password else self.DEFAULT_PASSWORD
         super().__init__(username, password)
-        self._type = "linux"
-        self.hostname = f"{self._type}-{username or self.DEFAULT_USERNAME}"
+        self.hostname = f"{self._type}-{username}"
 
 
 class RADIUSServer(LinuxDevice):
+    __slots__ = ()
+
     def __init__(self, username: Optional[str]=None, password: Optional[str]=None):
         super().__init__(username, password)
         self.hostname = "radius-server"
 
 
 class OneOS6Device(Device):
+    __slots__ = ()
+    _type = "oneos"
     DEFAULT_USERNAME = 'admin'
     DEFAULT_PASSWORD = 'admin'
     DEFAULT_PROMPT_SYMBOL = '#'
@@ -89,25 +108,152 @@ class OneOS6Device(Device):
         username = username if username else self.DEFAULT_USERNAME
         password = password if password else self.DEFAULT_PASSWORD
         super().__init__(username, password)
-        self._type = "oneos"
         self.hostname = "localhost"
 
 
 class HostDevice():
-    @staticmethod
-    def write_command(command: str, print_response=False, quiet=False) -> Optional[str]:
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+    _shell: Optional[subprocess.Popen] = None  # Long-lived shell, started on first persistent command
+    _SHELL_SENTINEL = "__ROUTER_TEST_KIT_END__"
+    _cache: Dict[Tuple[str, bool, Optional[bool]], Optional[str]] = {}  # Outputs of successful commands executed with cache=True
+    _CACHE_MAX_SIZE = 128
 
-        responses = []
-        if process.returncode != 0 and not quiet:
-            logger.error(f"Error executing command: {command}")
-            logger.error(f"Error message: {stderr.decode()}")
-        else:
-            response = stdout.decode()
-            if print_response and not quiet:
-                logger.debug(f"Command executed successfully: {command}")
+    @classmethod
+    def write_command(cls, command: str, print_response=False, quiet=False, use_shell: Optional[bool] = None, persistent: bool = False, cache: bool = False, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Executes a command on the host machine and returns its output (stdout and stderr combined).
+
+        Commands without shell metacharacters are split with shlex and executed directly, without spawning an intermediate shell.
+            If their first word is not an executable (i.e. a shell builtin such as "cd" or "command"), they are run through /bin/sh instead.
+        Commands relying on shell features (pipes, redirections, globbing, etc.) are executed through /bin/sh.
+        With persistent=True, the command is piped to a long-lived bash process instead of spawning a new process,
+            which is much faster for many short commands. Shell state (cwd, variables) is kept between such commands.
+        With cache=True, the output of a successful command is memoized and returned on later cached calls,
+            which is meant for idempotent queries (i.e. "uname -r"). Use clear_cache() to invalidate.
+            Outputs are cached per command, persistent and use_shell, so that a result from the persistent shell
+            (where cwd and variables carry over) is never reused for a fresh process, or the other way around.
+
+        Args:
+            command (str): The command to execute.
+            print_response (bool, optional): If True, the output is logged on success. Defaults to False.
+            quiet (bool, optional): If True, nothing is logged, not even errors. Defaults to False.
+            use_shell (Optional[bool]): If True, the command is executed through /bin/sh, if False it is executed directly.
+                If None, the choice is made by looking for shell metacharacters in the command,
+                and falls back to /bin/sh when no such executable exists. Defaults to None.
+            persistent (bool, optional): If True, the command is executed in the long-lived bash process. Defaults to False.
+            cache (bool, optional): If True, reuse (or store) the memoized output of this command. Defaults to False.
+            timeout (Optional[float]): Seconds to wait for the command to finish. If None, wait forever. Defaults to None.
+                On expiry, the command (or the whole persistent shell) is killed.
+
+        Returns:
+            Optional[str]: The output of the command, or None if there was no output.
+
+        Raises:
+            subprocess.TimeoutExpired: If the command did not finish within the timeout.
+        """
+        cache_key = (command, persistent, use_shell)
+        if cache and cache_key in cls._cache:
+            response = cls._cache[cache_key]
+            if print_response and not quiet and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Command output reused from cache: {command}")
                 logger.debug(f"Output: {response}")
-        responses.append(stdout.decode()) if stdout else None
-        responses.append(stderr.decode()) if stderr else None
-        return '\n'.join(responses) if responses else None
+            return response
+        try:
+            if persistent:
+                returncode, response = cls._run_in_shell(command, timeout)
+            else:
+                shell_fallback = use_shell is None
+                if use_shell is None:
+                    use_shell = SHELL_METACHARACTERS_RE.search(command) is not None
+                args = command if use_shell else shlex.split(command)
+                try:
+                    process = subprocess.run(args, shell=use_shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+                except FileNotFoundError:
+                    if not shell_fallback or use_shell:
+                        raise
+                    # Not an executable, i.e. a shell builtin, so let /bin/sh run it (or report it as not found)
+                    process = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+                returncode, response = process.returncode, process.stdout.decode()
+        except OSError as error:
+            # i.e. executable not found, which the shell would otherwise have reported in the output
+            if not quiet:
+                logger.error(f"Error executing command: {command}")
+                logger.error(f"Error message: {error}")
+            return str(error)
+
+        if returncode != 0 and not quiet:
+            logger.error(f"Error executing command: {command}")
+            logger.error(f"Error message: {response}")
+        elif print_response and not quiet and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Command executed successfully: {command}")
+            logger.debug(f"Output: {response}")
+        response = response if response else None
+        if cache and returncode == 0:
+            if len(cls._cache) >= cls._CACHE_MAX_SIZE:
+                del cls._cache[next(iter(cls._cache))]  # Evict the oldest entry
+            cls._cache[cache_key] = response
+        return response
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        """
+        Forgets all the memoized command outputs.
+        """
+        cls._cache.clear()
+
+    @classmethod
+    def _run_in_shell(cls, command: str, timeout: Optional[float] = None) -> Tuple[int, str]:
+        """
+        Writes the command to the long-lived shell and reads its output until the sentinel line carrying the exit code.
+        The command is passed quoted to eval, so that a syntax error (i.e. an unterminated quote) is reported by bash
+            instead of swallowing the sentinel. Its stdin is redirected from /dev/null, so that it cannot consume the rest of the protocol.
+        """
+        if cls._shell is None or cls._shell.poll() is not None:
+            cls._shell = subprocess.Popen(
+                ["/bin/bash"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            )
+        shell = cls._shell
+        shell.stdin.write(f"eval {shlex.quote(command)} < /dev/null\necho \"{cls._SHELL_SENTINEL}$?\"\n".encode())
+        shell.stdin.flush()
+
+        # Read the raw pipe with select, so that a deadline can be enforced
+        stdout_fd = shell.stdout.fileno()
+        sentinel = cls._SHELL_SENTINEL.encode()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        output = b""
+        search_start = 0
+        while True:
+            # The sentinel might follow output that is not terminated by a newline
+            index = output.find(sentinel, search_start)
+            if index != -1:
+                end = output.find(b"\n", index)
+                if end != -1:
+                    return int(output[index + len(sentinel):end]), output[:index].decode()
+            else:
+                search_start = max(0, len(output) - len(sentinel))
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([stdout_fd], [], [], remaining)[0]:
+                    shell.kill()
+                    shell.wait()
+                    cls._shell = None  # Its state is lost, restarted by the next persistent command
+                    raise subprocess.TimeoutExpired(command, timeout, output=output)
+            chunk = os.read(stdout_fd, 65536)
+            if not chunk:
+                break
+            output += chunk
+        shell.wait()
+        cls._shell = None  # Restarted by the next persistent command
+        raise BrokenPipeError(f"The persistent shell exited while executing: {command}")
+
+    @classmethod
+    def close(cls) -> None:
+        """
+        Terminates the long-lived shell, if it has been started.
+        """
+        if cls._shell is not None and cls._shell.poll() is None:
+            cls._shell.stdin.close()
+            cls._shell.wait()
+        cls._shell = None
+
+
+atexit.register(HostDevice.close)
@@ -22,14 +22,21 @@ def setup_logger():
     If the logs directory does not exist, it is created.
     The log messages are formatted to include the date and time, the name of the logger, the level of the log message, and the log message itself.
     The file handler is added to the logger.
+    Calling it again is a no-op, so the log file is opened once and messages are not duplicated.
+
+    Returns:
+        logging.Logger: The configured logger.
     """
     # Create a logger
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
 
+    # Already set up (loggers are cached by name), keep the existing file handler
+    if any(isinstance(handler, logging.FileHandler) for handler in logger.handlers):
+        return logger
+
     # Create a logs directory if it doesn't exist
-    if not os.path.exists("logs"):
-        os.makedirs("logs")
+    os.makedirs("logs", exist_ok=True)
 
     # Define a handler to output log messages to a file
     file_handler = logging.FileHandler("logs/debug.log")
@@ -43,3 +50,4 @@ def setup_logger():
 
     # Add file handler to the logger
     logger.addHandler(file_handler)
+    return logger
@@ -1,22 +1,42 @@
 import re
 import json
 import time
+import functools
 import logging
 import subprocess
 import ipaddress
-import sys
+import shlex
+import socket
 import os
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Union
 
 import pytest
 
-# Add the root directory to the Python path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
-from router_test_kit.device import HostDevice
+try:
+    import orjson  # Optional, faster JSON parsing
+except ImportError:
+    orjson = None
+
+try:
+    from pyroute2 import IPRoute  # Optional, reads interface addresses over netlink
+except ImportError:
+    IPRoute = None
+
+from router_test_kit.device import HostDevice, SHELL_METACHARACTERS_RE
 from router_test_kit.connection import TelnetConnection
 
 logger = logging.getLogger(__name__)
 
+SSH_CONTROL_PERSIST = 60  # Seconds that an idle multiplexed SSH connection is kept open by scp_file_to_home_dir
+SSH_CONTROL_DIR = os.path.join(os.path.expanduser("~"), ".ssh")  # Private (0700) directory holding the control sockets
+REBOOT_POLL_INITIAL_DELAY = 0.5  # Seconds between the first reboot_device pings, doubled after each failed one
+REBOOT_POLL_MAX_DELAY = 8
+REBOOT_PING_COUNT = 3  # Packets per reboot_device probe, sent REBOOT_PING_INTERVAL seconds apart by a single ping process
+REBOOT_PING_INTERVAL = 0.2  # Shortest interval allowed to non-root users
+COMMAND_SEPARATOR = "__ROUTER_TEST_KIT_SEP__"  # Printed after each command of a batch, followed by its exit code
+COMMAND_SEPARATOR_RE = re.compile(COMMAND_SEPARATOR + r"(-?\d+)\n")
+_collected_tests: Optional[List["pytest.Item"]] = None  # Set by cache_collected_tests() during a pytest session
+
 
 class TestCollector:
     """ A pytest plugin to collect test items. """
@@ -25,87 +45,206 @@ class TestCollector:
         self.test_items = session.items
 
 
-def get_tests() -> TestCollector:
+def get_tests() -> List["pytest.Item"]:
+    """
+    Returns the collected test items.
+    Inside a running pytest session, the items handed to cache_collected_tests() are reused.
+    Otherwise (i.e. standalone script), a collect-only pytest run is performed.
+    """
+    if _collected_tests is not None:
+        return list(_collected_tests)
     collector = TestCollector()
     pytest.main(["--no-header", "--no-summary", "-qq", "--collect-only"], plugins=[collector])
     test_items = collector.test_items
     return test_items
 
 
+def cache_collected_tests(items: List["pytest.Item"]) -> None:
+    """ To be called from the pytest_collection_modifyitems hook, so that get_tests() does not collect again. """
+    global _collected_tests
+    _collected_tests = items
+
+
 def load_json(file_path):
+    """
+    Loads a JSON file. The parsed result is cached until the file is modified,
+        so callers must treat the returned data as read-only.
+    """
+    return _load_json_cached(file_path, os.path.getmtime(file_path))
+
+
+@functools.lru_cache(maxsize=64)
+def _load_json_cached(file_path, mtime):
     # Assuming that the file is JSON
-    with open(file_path, 'r') as json_file:
-        data = json.load(json_file)
-    return data
+    with open(file_path, 'rb') as json_file:
+        content = json_file.read()
+    return orjson.loads(content) if orjson is not None else json.loads(content)
 
 
 def print_banner(*messages: str, banner_legth = 80) -> None:
     """Prints a banner out of any number of messages."""
     border = "*" * banner_legth
-    logger.info(border)
-    for message in messages:
-        logger.info(message.center(banner_legth))
-    logger.info(border)
+    # One logging call for the whole banner, instead of one per line
+    logger.info('\n'.join([border, *(message.center(banner_legth) for message in messages), border]))
 
 
-def execute_shell_commands_on_host(commands: List[str], print_response = False, quiet = False) -> Optional[str]:
+def execute_shell_commands_on_host(commands: List[Union[str, List[str]]], print_response = False, quiet = False, batched: bool = True, capture: bool = True, stdin_text: Optional[str] = None) -> Optional[str]:
+    """
+    Executes shell commands on the host and returns their joined output, or None if there was no output.
+    The output of each command is its stdout and stderr combined, in the order they were printed, whether batched or not.
+
+    A command is either a string or an argv list. Argv lists, and strings without shell metacharacters,
+        are executed directly without spawning an intermediate shell, when they are not batched.
+
+    With batched=True (default), multiple commands are executed by a single shell process (each one in its own subshell,
+        so that they stay independent of each other), instead of spawning a new shell per command.
+
+    With capture=False, the output is sent to /dev/null instead of being piped back and decoded, and None is returned.
+        Failures are still logged, but without their error message.
+
+    With stdin_text, the given text is written to the stdin of each command (i.e. a password for "sudo -S"),
+        so the commands are never batched.
+    """
     # Might require root privileges
-    responses = []
-    for command in commands:
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+    if batched and len(commands) > 1 and stdin_text is None:
+        results = _execute_batch_on_host(commands, capture)
+    else:
+        results = [_execute_on_host(command, capture, stdin_text) for command in commands]
 
-        if process.returncode != 0 and not quiet:
+    responses = []
+    for command, (returncode, output) in zip(map(_command_to_str, commands), results):
+        if returncode != 0 and not quiet:
             logger.error(f"Error executing command: {command}")
-            logger.error(f"Error message: {stderr.decode()}")
-        else:
-            response = stdout.decode()
-            if print_response and not quiet:
-                logger.debug(f"Command executed successfully: {command}")
-                logger.debug(f"Output: {response}")
-        if stdout:
-            responses.append(stdout.decode())
-        if stderr:
-            responses.append(stderr.decode())
+            logger.error(f"Error message: {output}")
+        elif print_response and not quiet:
+            logger.debug(f"Command executed successfully: {command}")
+            logger.debug(f"Output: {output}")
+        if output:
+            responses.append(output)
     if responses:
         return '\n'.join(responses)
     else:
         return None
 
 
+def _command_to_str(command: Union[str, List[str]]) -> str:
+    return command if isinstance(command, str) else ' '.join(shlex.quote(arg) for arg in command)
+
+
+def _execute_on_host(command: Union[str, List[str]], capture: bool = True, stdin_text: Optional[str] = None) -> Tuple[int, str]:
+    shell_command = None  # The original string, if it is split to be executed without a shell
+    if isinstance(command, str) and SHELL_METACHARACTERS_RE.search(command) is None:
+        shell_command, command = command, shlex.split(command)
+    stream = subprocess.PIPE if capture else subprocess.DEVNULL
+    stdin = subprocess.PIPE if stdin_text is not None else None
+    try:
+        try:
+            process = subprocess.Popen(command, shell=isinstance(command, str), stdin=stdin, stdout=stream, stderr=subprocess.STDOUT)
+        except FileNotFoundError:
+            if shell_command is None:
+                raise
+            # Not an executable, i.e. a shell builtin such as "cd", so let /bin/sh run it (or report it as not found)
+            process = subprocess.Popen(shell_command, shell=True, stdin=stdin, stdout=stream, stderr=subprocess.STDOUT)
+    except OSError as error:
+        return 127, str(error) if capture else ""  # Executable not found, as the shell would report it
+    stdout, _ = process.communicate(stdin_text.encode() if stdin_text is not None else None)
+    return process.returncode, stdout.decode() if stdout else ""
+
+
+def _execute_batch_on_host(commands: List[Union[str, List[str]]], capture: bool = True) -> List[Tuple[int, str]]:
+    """
+    Runs all commands in one shell, printing a separator line with the exit code after each one.
+    The output (stdout and stderr combined) is then split back per command.
+    Each command is parsed by eval in its own subshell, so that a syntax error (i.e. an unterminated quote)
+        only fails that command instead of the rest of the script.
+    """
+    redirect = "" if capture else " >/dev/null 2>&1"  # Only the separators are read back
+    script = "".join(
+        f"( eval {shlex.quote(_command_to_str(command))} ){redirect}\necho \"{COMMAND_SEPARATOR}$?\"\n" for command in commands
+    )
+    process = subprocess.Popen(script, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    stdout, _ = process.communicate()
+
+    # [output_1, returncode_1, output_2, returncode_2, ..., trailing output]
+    parts = COMMAND_SEPARATOR_RE.split(stdout.decode())
+    results = [(int(returncode), output) for output, returncode in zip(parts[0::2], parts[1::2])]
+    # If the shell died midway, consider the remaining commands as failed,
+    # and keep whatever was printed after the last separator (i.e. the shell's error) with the first of them
+    if len(results) < len(commands):
+        results.append((-1, parts[-1]))
+        results += [(-1, "")] * (len(commands) - len(results))
+    return results
+
+
 def set_interface_ip(interface_name: str, ip: str, password: str, netmask: str = "24") -> None:
     if '/' not in ip:
         ip = f"{ip}/{netmask}"
-    command = f"echo {password} | sudo -S ip addr add {ip} dev {interface_name}"
-    execute_shell_commands_on_host([command], quiet=True)
+    # The password is fed to sudo's stdin, instead of echoing it in a shell pipeline (where it also shows up in ps)
+    command = ["sudo", "-S", "ip", "addr", "add", ip, "dev", interface_name]
+    execute_shell_commands_on_host([command], quiet=True, capture=False, stdin_text=f"{password}\n")
 
 
 def del_interface_ip(interface: str, ip: str, password: str, netmask: str = "24") -> None:
     if '/' not in ip:
         ip = f"{ip}/{netmask}"
-    command = f"echo {password} | sudo -S ip addr del {ip} dev {interface}"
+    command = ["sudo", "-S", "ip", "addr", "del", ip, "dev", interface]
 
     # If the IP to be deleted is the only one on the interface, skip
     # Useful for: if developer uses their standard IP, it will not be deleted
-    ipv4s, ipv6s = get_interface_ips(interface)
-    if len(ipv4s) == 1 and ip.split('/')[0] in ipv4s:
-        return
-    if len(ipv6s) == 1 and ip.split('/')[0] in ipv6s:
-        return
-    execute_shell_commands_on_host([command])
+    # Compared as address objects, since the interface reports them in canonical form (i.e. lowercase, compressed IPv6)
+    try:
+        address = ipaddress.ip_address(ip.split('/')[0])
+    except ValueError:
+        address = None  # Not an address, let "ip addr del" report it
+    if address is not None:
+        ipv4s, ipv6s = (list(map(ipaddress.ip_address, ips)) for ips in get_interface_ips(interface))
+        if len(ipv4s) == 1 and address in ipv4s:
+            return
+        if len(ipv6s) == 1 and address in ipv6s:
+            return
+        # Nothing to delete, skip spawning sudo
+        if address not in ipv4s and address not in ipv6s:
+            return
+    execute_shell_commands_on_host([command], stdin_text=f"{password}\n")
 
 
 def get_interface_ips(interface: str) -> Tuple[List[str], List[str]]:
+    """
+    Returns the IPv4 and IPv6 addresses of a host interface.
+    Queried over netlink when pyroute2 is installed, otherwise parsed from the output of "ip addr show".
+    """
+    if IPRoute is not None:
+        return _get_interface_ips_netlink(interface)
     response = execute_shell_commands_on_host([f"ip addr show {interface}"])
-    ipv4_pattern = r"\binet (\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b)"
-    ipv4_matches = re.findall(ipv4_pattern, response)
-    ipv6_pattern = r"\binet6 ([a-f0-9:]+)"
-    ipv6_matches = re.findall(ipv6_pattern, response)
-    return ipv4_matches if ipv4_matches else [], ipv6_matches if ipv6_matches else []
+    # Address lines look like "    inet 172.31.1.1/24 brd ..." or "    inet6 fe80::1/64 scope link"
+    ipv4s, ipv6s = [], []
+    for line in (response or "").splitlines():
+        line = line.lstrip()
+        if line.startswith("inet "):
+            ipv4s.append(line.split(None, 2)[1].split("/", 1)[0])
+        elif line.startswith("inet6 "):
+            ipv6s.append(line.split(None, 2)[1].split("/", 1)[0])
+    return ipv4s, ipv6s
+
+
+def _get_interface_ips_netlink(interface: str) -> Tuple[List[str], List[str]]:
+    ipv4s, ipv6s = [], []
+    with IPRoute() as ipr:
+        indexes = ipr.link_lookup(ifname=interface)
+        if not indexes:
+            logger.error(f"Interface {interface} not found on host")
+            return ipv4s, ipv6s
+        for address in ipr.get_addr(index=indexes[0]):
+            if address["family"] == socket.AF_INET:
+                # IFA_ADDRESS is the peer on point-to-point links, IFA_LOCAL is always the local address
+                ipv4s.append(address.get_attr("IFA_LOCAL") or address.get_attr("IFA_ADDRESS"))
+            elif address["family"] == socket.AF_INET6:
+                ipv6s.append(address.get_attr("IFA_ADDRESS"))
+    return ipv4s, ipv6s
 
 
 def reboot_device(connection: "TelnetConnection", timeout: int = 60) -> "TelnetConnection":
-    if connection is None or not connection.is_connected():
+    if connection is None or not connection.is_connected:
         raise ConnectionError("Connection is not established. Cannot reboot device.")
 
     vm_ip = connection.destination_ip
@@ -114,20 +253,36 @@ def reboot_device(connection: "TelnetConnection", timeout: int = 60) -> "TelnetC
     connection.write_command("/sbin/reboot")
     connection.disconnect()
 
-    start_time = time.time()
+    # The device keeps answering for a moment after /sbin/reboot, so first wait for it to go down, then to come back up.
+    # Back off between pings once it is down, a reboot takes a while and each ping spawns a process
+    start_time = time.monotonic()
+    delay = REBOOT_POLL_INITIAL_DELAY
+    device_down = False
     while True:
-        packet_loss = get_packet_loss(vm_ip)
-        if packet_loss == 0:
+        packet_loss = get_packet_loss(ping(vm_ip, count=REBOOT_PING_COUNT, interval=REBOOT_PING_INTERVAL))
+        if device_down and packet_loss == "0":
             break
-        if timeout and time.time() - start_time > timeout:
+        device_down = device_down or packet_loss != "0"
+        elapsed = time.monotonic() - start_time
+        if timeout and elapsed > timeout:
             raise TimeoutError(f"Rebooting device {vm} took too long. Timeout reached.")
+        time.sleep(min(delay, timeout - elapsed) if timeout else delay)
+        if device_down:
+            delay = min(delay * 2, REBOOT_POLL_MAX_DELAY)
 
     connection.connect(vm, vm_ip)
     return connection
 
 
-def ping(destination_ip: str, count: int = 1) -> str:
-    return execute_shell_commands_on_host([f"ping -c {count} {destination_ip}"])
+def ping(destination_ip: str, count: int = 1, interval: Optional[float] = None) -> str:
+    """
+    Pings the destination count times from the host, with one ping process.
+    The interval (in seconds) between the packets is ping's default (1s) unless given.
+    """
+    args = ["ping", "-c", str(count)]
+    if interval is not None:
+        args += ["-i", str(interval)]
+    return execute_shell_commands_on_host([[*args, destination_ip]])
 
 
 def get_packet_loss(response: str) -> str:
@@ -137,29 +292,58 @@ def get_packet_loss(response: str) -> str:
     Returned value:
         '0' (if pings have been successful)
     """
-    match = re.search(r"\d+(?=%)", response)
-    if match:
-        return match.group()
-    else:
+    if not response:
         logger.critical(f"Ping: Could not find packet loss percentage in response: {response}")
+        return None
+    # The summary is at the end of the response, so walk backwards over the '%' signs until one follows a number
+    end = len(response)
+    while True:
+        percent = response.rfind('%', 0, end)
+        if percent < 0:
+            logger.critical(f"Ping: Could not find packet loss percentage in response: {response}")
+            return None
+        start = percent
+        while start > 0 and response[start - 1] in "0123456789":
+            start -= 1
+        if start < percent:
+            return response[start:percent]
+        end = percent
 
 
 def is_valid_ip(ip: str) -> bool:
+    if not isinstance(ip, str):
+        return False  # i.e. None for a missing "ip" key in the JSON config
     try:
-        ipaddress.ip_address(ip)
+        # Dispatch on the separator instead of letting ip_address() fail on IPv4 first for every IPv6 address
+        if ':' in ip:
+            ipaddress.IPv6Address(ip)
+        else:
+            ipaddress.IPv4Address(ip)
         return True
     except ValueError:
         return False
 
 
+@functools.lru_cache(maxsize=None)
+def is_sshpass_installed() -> bool:
+    """
+    Checks once per session whether sshpass is available on the host, since the answer does not change.
+    """
+    response = HostDevice.write_command("sshpass", quiet=True)
+    return response is not None and "Usage: sshpass" in response
+
+
 def scp_file_to_home_dir(local_file_path: str, user_at_ip: str, password: str) -> None:
-    # Check if sshpass is installed on device
     host_vm = HostDevice()
-    response = host_vm.write_command("sshpass")
-    # response = execute_shell_commands_on_host(["sshpass"])
-    if "Usage: sshpass" not in response:
+    if not is_sshpass_installed():
         logger.critical('sshpass is not installed on the device. Please install it by "sudo apt install sshpass"')
-    command = f"sshpass -p {password} scp {local_file_path} {user_at_ip}:~"
+    # Multiplex the transfers to the same destination over one SSH connection, kept open for a while after the last one
+    # The socket lives in the user's own ~/.ssh, not in the shared temp directory where anyone could create it first,
+    # and ssh's %C token (a hash of the local host, remote host, port and user) names it per destination
+    os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+    control_path = shlex.quote(os.path.join(SSH_CONTROL_DIR, "router-test-kit-%C"))
+    ssh_options = f"-o ControlMaster=auto -o ControlPath={control_path} -o ControlPersist={SSH_CONTROL_PERSIST}"
+    command = f"sshpass -p {password} scp {ssh_options} {local_file_path} {user_at_ip}:~"
     response = host_vm.write_command(command)
     if response is None:
         return
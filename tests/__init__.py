@@ -6,8 +6,8 @@ import sys
 
 # Add the root directory to the path so that the package can be imported
 root_directory = os.path.abspath(os.path.dirname(__file__))
-print(root_directory)
-sys.path.insert(0, root_directory)
+if root_directory not in sys.path:
+    sys.path.insert(0, root_directory)
 
 from .logger import setup_logger
 
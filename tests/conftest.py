@@ -4,16 +4,19 @@
 import os
 import sys
 import re
-import json
 import getpass
 import logging
+import functools
+from collections import Counter
 from typing import List, Tuple
 
 import pytest
 
 # Add the root directory to the Python path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
-from src.static_utils import print_banner, load_json
+root_directory = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+if root_directory not in sys.path:
+    sys.path.insert(0, root_directory)
+from src.static_utils import print_banner, load_json, cache_collected_tests, is_valid_ip
 
 
 ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -37,49 +40,70 @@ SKIPPED = "[SKIPPED] - "
 
 logger = logging.getLogger(__name__)
 json_config = load_json(os.path.join(ROOT_PATH, IPSEC_CFG_DIR_NAME, IPSEC_JSON_NAME))
+VM_NAMES = ("VM_A", "VM_B", "VM_C", "VM_D")
 finished_header = False
+NON_ALPHANUMERIC_RE = re.compile(r"[^a-zA-Z0-9]")
+
+
+def validate_vm_ips(config) -> None:
+    """
+    Validates the VM IPs once at config load, so that a typo fails fast
+    instead of surfacing as a ping/telnet timeout in the middle of a test.
+    """
+    for vm_name in VM_NAMES:
+        ip = config.get(vm_name, {}).get('ip')
+        if ip is not None and not is_valid_ip(ip):
+            raise ValueError(f"Invalid IP address for {vm_name} in {IPSEC_JSON_NAME}: {ip}")
+
+
+validate_vm_ips(json_config)
+
+
+HELP_TEXT = '\n'.join([
+    "",
+    "Usage: test_offline_vm.sh -a <linux ip address VM_A> -b <linux ip address VM_B>[<list of tests>]",
+    "",
+    "This test script makes following assumptions:",
+    "  * 2 VMs are required (VM_A and VM_B); 1 VM optional for NAT (VM_C); 1 VM optional for second client (VM_D)",
+    "  * VM_A:GigabitEthernet 0/0 -------  VM_B:GigabitEthernet 0/0 virtnet1 172.31.1.0   .1<->.2",
+    "  * VM_A:GigabitEthernet 0/1 -------  VM_C:GigabitEthernet 0/0 virtnet3 172.31.2.0   .1<->.3",
+    "  * VM_B:GigabitEthernet 0/1 -------  VM_C:GigabitEthernet 0/1 virtnet2 172.31.3.0   .2<->.3",
+    "  * VM_A:GigabitEthernet 0/0 -------  Host PC                  virtnet1 172.31.1.0",
+    "  * VM_A:GigabitEthernet 0/1 -------  Host PC                  virtnet3 172.31.2.0",
+    "  * VM_D:GigabitEthernet 0/0 -------  VM_C:GigabitEthernet 0/2 virtnet4 172.31.4.0",
+    "  * all VMs (except VM_C) are  connected to the internet on interface GigabitEthernet 0/2",
+    "  * All VMs have their Linux port 2222 available: addresses are passed on the command line",
+    "  * the script uses a ssh public key authentication - to put the key on the dut (needed once) execute ",
+    "  *  ssh-copy-id -i ipsec_testsetup.key -p 2222 root@<linux-IP-of-DUT>",
+    "  * On all VMs a public key for ssh with user root is installed (this requires persistent memory)",
+    "  * Run this script as root",
+    "  * On all VMs a user kubu with password kubu and administrator rights is added -> check /media/user/pub/password",
+    "",
+    "Execute specific tests:",
+    "    i.e. execute test setups 1, 2 and 3:",
+    '        $ pytest test_ipsec -k "test_setup1 or test_setup2 or test_setup3"',
+    "    i.e. execute all tests but the NAT test",
+    '        $ pytest test_ipsec -k "not test_setup10"',
+    "",
+    "Pytest Options Quickview:",
+    "    -v, --verbose    increase info of pytest summary",
+    "    -q, --quiet      decrease info of pytest summary",
+    "    --log-cli-level=LOG_CLI_LEVEL,",
+    "                     set the log level for the console logging",
+    "    --no-header      Disable header",
+    "    -h, --help       print pytest help",
+    "    --ipsec-help     print this help",
+    "",
+    "Possible tests:",
+])
 
 
 def print_help():
-    print()
-    print("Usage: test_offline_vm.sh -a <linux ip address VM_A> -b <linux ip address VM_B>[<list of tests>]")
-    print()
-    print("This test script makes following assumptions:")
-    print("  * 2 VMs are required (VM_A and VM_B); 1 VM optional for NAT (VM_C); 1 VM optional for second client (VM_D)")
-    print("  * VM_A:GigabitEthernet 0/0 -------  VM_B:GigabitEthernet 0/0 virtnet1 172.31.1.0   .1<->.2")
-    print("  * VM_A:GigabitEthernet 0/1 -------  VM_C:GigabitEthernet 0/0 virtnet3 172.31.2.0   .1<->.3")
-    print("  * VM_B:GigabitEthernet 0/1 -------  VM_C:GigabitEthernet 0/1 virtnet2 172.31.3.0   .2<->.3")
-    print("  * VM_A:GigabitEthernet 0/0 -------  Host PC                  virtnet1 172.31.1.0")
-    print("  * VM_A:GigabitEthernet 0/1 -------  Host PC                  virtnet3 172.31.2.0")
-    print("  * VM_D:GigabitEthernet 0/0 -------  VM_C:GigabitEthernet 0/2 virtnet4 172.31.4.0")
-    print("  * all VMs (except VM_C) are  connected to the internet on interface GigabitEthernet 0/2")
-    print("  * All VMs have their Linux port 2222 available: addresses are passed on the command line")
-    print("  * the script uses a ssh public key authentication - to put the key on the dut (needed once) execute ")
-    print("  *  ssh-copy-id -i ipsec_testsetup.key -p 2222 root@<linux-IP-of-DUT>")
-    print("  * On all VMs a public key for ssh with user root is installed (this requires persistent memory)")
-    print("  * Run this script as root")
-    print("  * On all VMs a user kubu with password kubu and administrator rights is added -> check /media/user/pub/password")
-    print()
-
-    print('Execute specific tests:')
-    print('    i.e. execute test setups 1, 2 and 3:')
-    print('        $ pytest test_ipsec -k "test_setup1 or test_setup2 or test_setup3"')
-    print('    i.e. execute all tests but the NAT test')
-    print('        $ pytest test_ipsec -k "not test_setup10"')
-
-    print()
-    print("Pytest Options Quickview:")
-    print("    -v, --verbose    increase info of pytest summary")
-    print("    -q, --quiet      decrease info of pytest summary")
-    print("    --log-cli-level=LOG_CLI_LEVEL,")
-    print("                     set the log level for the console logging")
-    print("    --no-header      Disable header")
-    print("    -h, --help       print pytest help")
-    print("    --ipsec-help     print this help")
-    print()
-    print("Possible tests:")
+    # Single write of the whole help, instead of one print() per line
+    sys.stdout.write(HELP_TEXT + '\n')
     print_tests()
-    print()
+    sys.stdout.write('\n')
+    sys.stdout.flush()  # The caller leaves through os._exit(), which does not flush
 
 
 def pytest_addoption(parser):
@@ -97,8 +121,7 @@ def print_tests():
     # Import in the scope of this function only to avoid circular dependency
     from test_ipsec import TEST_SETUPS_GENERIC
 
-    for test_nbr, test_setup, test_name in TEST_SETUPS_GENERIC:
-        print(f"{test_setup}:\t{test_name}")
+    sys.stdout.write(''.join(f"{test_setup}:\t{test_name}\n" for test_nbr, test_setup, test_name in TEST_SETUPS_GENERIC))
 
 
 @pytest.fixture(scope="function", autouse=True)
@@ -111,11 +134,6 @@ def print_custom_banner(request):
 
 def pytest_sessionstart(session):
     """Effort to keep the same banner format as in old IPSEC tests."""
-    root_path = os.path.dirname(os.path.abspath(__file__))
-    json_path = os.path.join(root_path, IPSEC_CFG_DIR_NAME, IPSEC_JSON_NAME)
-    with open(json_path) as f:
-        json_config = json.load(f)
-
     vm_a_ip = json_config.get('VM_A', {}).get('ip', 'No assigned IP')
     vm_b_ip = json_config.get('VM_B', {}).get('ip', 'No assigned IP')
     vm_c_ip = json_config.get('VM_C', {}).get('ip', 'No assigned IP')
@@ -149,6 +167,7 @@ def pytest_collection_modifyitems(config, items):
     """Called after the collection of all available tests."""
     global COLLECTED_SETUPS
     COLLECTED_SETUPS = items
+    cache_collected_tests(items)
 
 
 def pytest_deselected(items):
@@ -163,7 +182,8 @@ def pytest_deselected(items):
     if finished_header:
         return
     global COLLECTED_SETUPS
-    selected_items = [item for item in COLLECTED_SETUPS if item not in items]
+    deselected_ids = {id(item) for item in items}
+    selected_items = [item for item in COLLECTED_SETUPS if id(item) not in deselected_ids]
     deselected_items = items
     reporter = items[0].session.config.pluginmanager.get_plugin("terminalreporter")
 
@@ -193,20 +213,13 @@ def pytest_deselected(items):
 
 
 def pytest_terminal_summary(terminalreporter, exitstatus, config):
-    report_types = ["passed", "failed", "skipped"]
-    reports = {report_type: terminalreporter.getreports(report_type) for report_type in report_types}
-    passed, failed, skipped = [[report for report in reports[status]] for status in report_types]
+    passed, failed, skipped = (terminalreporter.getreports(report_type) for report_type in ["passed", "failed", "skipped"])
 
     # For each test, three reports are retrieved: setup, execution and teardown
-    passed_counts = _count_report_occurences(passed)
-    skipped_counts = _count_report_occurences(skipped)
-    # Remove reports that are not thrice in the list -> if any phase of report is missing, consider test as failed
-    passed = [report for report in passed if passed_counts[report.nodeid] == 3]
-    skipped = [report for report in skipped if skipped_counts[report.nodeid] == 3]
-    # Remove duplicates based on nodeid
-    passed = list({report.nodeid: report for report in passed}.values())
-    failed = list({report.nodeid: report for report in failed}.values())
-    skipped = list({report.nodeid: report for report in skipped}.values())
+    # If any phase of a passed/skipped report is missing, consider test as failed
+    passed = _deduplicate_reports(passed, required_count=3)
+    skipped = _deduplicate_reports(skipped, required_count=3)
+    failed = _deduplicate_reports(failed)
 
     _print_reports(terminalreporter, skipped, 'Skipped tests', 'yellow')
     _print_reports(terminalreporter, passed, 'Successful tests', 'green')
@@ -225,14 +238,17 @@ def _print_reports(terminalreporter, reports, section_title, color):
         terminalreporter.line(_parse_content(content))
 
 
-def _count_report_occurences(reports):
-    report_counts = {}
+def _deduplicate_reports(reports, required_count=None):
+    """
+    Keeps one (the last) report per nodeid, in a single pass.
+    If required_count is given, nodeids that do not appear exactly that many times are dropped.
+    """
+    unique_reports, report_counts = {}, Counter()
     for report in reports:
-        if report.nodeid in report_counts:
-            report_counts[report.nodeid] += 1
-        else:
-            report_counts[report.nodeid] = 1
-    return report_counts
+        report_counts[report.nodeid] += 1
+        unique_reports[report.nodeid] = report
+    return [report for nodeid, report in unique_reports.items()
+            if required_count is None or report_counts[nodeid] == required_count]
 
 
 def _parse_content(content: str) -> str:
@@ -243,8 +259,7 @@ def _parse_content(content: str) -> str:
             test_name = test_name.split('.py::')[-1]
             setup, rest = params.split('-', 1)
             final_string = test_name + " - " + setup + ': ' + rest.rstrip(']')
-            pattern = r"(?<!\s)(-\w+)+$"  # Remove the keywords
-            cleaned_text = re.sub(pattern, '', final_string)
+            cleaned_text = _strip_keywords_suffix(final_string)  # Remove the keywords
             parsed_content += cleaned_text + '\n'
         # If there is no extra information, the line is the test name
         except ValueError:
@@ -254,6 +269,22 @@ def _parse_content(content: str) -> str:
     return parsed_content
 
 
+def _strip_keywords_suffix(text: str) -> str:
+    r"""
+    Removes the trailing "-keyword1-keyword2..." run of a test name, if not preceded by whitespace.
+    Equivalent to re.sub(r"(?<!\s)(-\w+)+$", '', text), by walking backwards over the dashes.
+    """
+    end = len(text)
+    while True:
+        dash = text.rfind('-', 0, end)
+        word = text[dash + 1:end]
+        if dash < 0 or not word or not all(char.isalnum() or char == '_' for char in word):
+            return text[:end]
+        if dash > 0 and text[dash - 1].isspace():
+            return text[:end]
+        end = dash
+
+
 @pytest.fixture(scope="session")
 def sudo_password():
     if os.geteuid() != 0:
@@ -281,7 +312,7 @@ def load_test_setups(test_name: str) -> List[Tuple[str, str, List[str]]]:
             logger.warning(f"Warning: No description found for setup {setup_marker}. Skipping this setup.")
             continue
         # Convert setup marker to lowercase and remove any non-alphanumeric characters
-        setup_marker_clean = re.sub(r"[^a-zA-Z0-9]", "", setup_marker_str.lower())
+        setup_marker_clean = NON_ALPHANUMERIC_RE.sub("", setup_marker_str.lower())
         # If keywords is not a list, convert it to a list
         if not isinstance(keywords, list):
             keywords = [keywords]
@@ -309,6 +340,22 @@ class KeywordsList(list):
         return f"KeywordsList(len={len(self)})"
 
 
-TEST_SETUPS_GENERIC = transform_test_setups(load_test_setups("test_ipsec_generic"))
-TEST_SETUPS_ALGORITHMS = transform_test_setups(load_test_setups("test_ipsec_algorithms"))
+@functools.lru_cache(maxsize=None)
+def _get_test_setups(test_name: str) -> List[Tuple[str, str, "KeywordsList"]]:
+    return transform_test_setups(load_test_setups(test_name))
+
+
+# Built on first access only (PEP 562), so that pytest runs not importing test_ipsec don't pay for it
+_LAZY_TEST_SETUPS = {
+    "TEST_SETUPS_GENERIC": "test_ipsec_generic",
+    "TEST_SETUPS_ALGORITHMS": "test_ipsec_algorithms",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_TEST_SETUPS:
+        return _get_test_setups(_LAZY_TEST_SETUPS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 COLLECTED_SETUPS = []
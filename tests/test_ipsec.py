@@ -33,7 +33,9 @@ from typing import Optional, Dict, List, Tuple, Set
 import pytest
 
 # Add the root directory to the Python path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+root_directory = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+if root_directory not in sys.path:
+    sys.path.insert(0, root_directory)
 import src.static_utils
 from src.device import OneOS6Device, RADIUSServer
 from src.connection import TelnetConnection